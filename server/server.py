@@ -20,17 +20,26 @@ Stage 3 adds ReaScript (Reaper -> POST /api/state and /api/select).
 from __future__ import annotations
 
 import argparse
-import json
+import asyncio
+import hashlib
 import os
+import socket
 import time
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Set
+from typing import Any, Dict, List, Optional, Tuple
 
+import orjson
 from aiohttp import web, WSMsgType
+from aiohttp.helpers import ETAG_ANY
 
+_HEALTH_BODY = b'{"ok":true}'
+# window in which bursts of POST /api/state are merged into one broadcast
+_BROADCAST_COALESCE_S = 0.005
+_MAX_INT = 2**63 - 1
 
-@dataclass
+
+@dataclass(slots=True)
 class TransportState:
     playing: bool = False
     bar: int = 1
@@ -39,15 +48,32 @@ class TransportState:
     ppq: float = 0.0
     ts_num: int = 4
     ts_den: int = 4
-    t_host: float = 0.0  # server timestamp (seconds)
+    t_host: float = 0.0  # server timestamp of the last update (seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        # flat literal build; avoids dataclasses.asdict's recursive deepcopy
+        return {
+            "playing": self.playing,
+            "bar": self.bar,
+            "beat": self.beat,
+            "bpm": self.bpm,
+            "ppq": self.ppq,
+            "ts_num": self.ts_num,
+            "ts_den": self.ts_den,
+            "t_host": self.t_host,
+        }
+
+
+def _positive_int(value: Any) -> int:
+    # clamp to >= 1; reject values orjson can't encode (beyond 64-bit)
+    n = max(1, int(value))
+    if n > _MAX_INT:
+        raise ValueError(f"integer out of range: {n}")
+    return n
 
-    def clamp(self) -> None:
-        self.bar = max(1, int(self.bar))
-        self.beat = max(1, int(self.beat))
-        self.bpm = float(self.bpm) if self.bpm else 120.0
-        self.ppq = float(self.ppq) if self.ppq else 0.0
-        self.ts_num = max(1, int(self.ts_num))
-        self.ts_den = max(1, int(self.ts_den))
+
+def _etag(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
 
 
 class AppState:
@@ -60,23 +86,124 @@ class AppState:
         self.projects = projects
         self.active_project_id = active_project_id
         self.state = state
-        self.ws_clients: Set[web.WebSocketResponse] = set()
+        self.ws_clients: List[web.WebSocketResponse] = []
+        self._broadcast_handle: Optional[asyncio.TimerHandle] = None
+        self._send_tasks: Dict[web.WebSocketResponse, asyncio.Task] = {}
+        self._send_pending: Dict[web.WebSocketResponse, bytes] = {}
+        # bpm / time signature parsed once per project
+        self.project_timing = {pid: parse_project_timing(p) for pid, p in projects.items()}
+        # pre-encoded responses; the project list is fixed at startup and the
+        # active project only changes on /api/select
+        self.projects_list_bytes = orjson.dumps(self.project_summaries())
+        self.project_bytes = orjson.dumps(self.get_active_project())
+        self.project_etag = _etag(self.project_bytes)
 
     def get_active_project(self) -> Dict[str, Any]:
         return self.projects[self.active_project_id]
 
+    def set_active_project(self, project_id: str) -> None:
+        self.active_project_id = project_id
+        self.project_bytes = orjson.dumps(self.get_active_project())
+        self.project_etag = _etag(self.project_bytes)
+
+    def project_summaries(self) -> List[Dict[str, Any]]:
+        items = []
+        for pid, project in self.projects.items():
+            meta = project.get("meta") or {}
+            song = meta.get("song") or meta.get("name") or pid
+            artist = meta.get("artist") or ""
+            items.append({"id": pid, "song": song, "artist": artist})
+        return items
+
     def state_payload(self) -> Dict[str, Any]:
         # include active project id
-        self.state.t_host = time.time()
-        self.state.clamp()
-        payload = asdict(self.state)
+        # fields (and t_host) are kept current by their writers, so reads don't touch state
+        payload = self.state.to_dict()
         payload["activeProjectId"] = self.active_project_id
         return payload
 
+    def schedule_broadcast(self) -> None:
+        # coalesce: updates arriving before the timer fires only overwrite state
+        if self._broadcast_handle is None:
+            loop = asyncio.get_running_loop()
+            self._broadcast_handle = loop.call_later(_BROADCAST_COALESCE_S, self._flush_broadcast)
+
+    def _flush_broadcast(self) -> None:
+        self._broadcast_handle = None
+        self.broadcast(orjson.dumps(self.state_payload()))
+
+    def broadcast(self, msg: bytes) -> None:
+        # hand the message to every open client without waiting on any of them;
+        # msg is already UTF-8 JSON, so it goes out as a text frame without re-encoding
+        for ws in self.ws_clients:
+            if not ws.closed:
+                self.send_latest(ws, msg)
+
+    def send_latest(self, ws: web.WebSocketResponse, msg: bytes) -> None:
+        # one send in flight per client; while it is busy only the newest message
+        # is kept, so a stalled socket neither blocks others nor queues up frames
+        task = self._send_tasks.get(ws)
+        if task is not None and not task.done():
+            self._send_pending[ws] = msg
+            return
+        self._send_tasks[ws] = asyncio.ensure_future(self._send_loop(ws, msg))
+
+    async def _send_loop(self, ws: web.WebSocketResponse, msg: Optional[bytes]) -> None:
+        try:
+            while msg is not None and not ws.closed:
+                await ws.send_frame(msg, WSMsgType.TEXT)
+                msg = self._send_pending.pop(ws, None)
+        except Exception:
+            # the ws_state handler removes the client once its socket closes
+            pass
+        finally:
+            self._send_tasks.pop(ws, None)
+            self._send_pending.pop(ws, None)
+
+    def remove_client(self, ws: web.WebSocketResponse) -> None:
+        self.ws_clients.remove(ws)
+        self._send_pending.pop(ws, None)
+        task = self._send_tasks.pop(ws, None)
+        if task is not None:
+            task.cancel()
+
+    async def cancel_broadcast(self) -> None:
+        if self._broadcast_handle is not None:
+            self._broadcast_handle.cancel()
+            self._broadcast_handle = None
+        self._send_pending.clear()
+        tasks = list(self._send_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 def load_project(project_path: Path) -> Dict[str, Any]:
-    with project_path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    return orjson.loads(project_path.read_bytes())
+
+
+def parse_project_timing(
+    project: Dict[str, Any],
+) -> Tuple[Optional[float], Optional[int], Optional[int]]:
+    # (bpm, ts_num, ts_den) from project meta; None where missing or malformed
+    meta = project.get("meta") or {}
+    bpm: Optional[float] = None
+    try:
+        raw_bpm = meta.get("bpm") or meta.get("tempo")
+        if raw_bpm:
+            bpm = float(raw_bpm)
+    except Exception:
+        pass
+    ts = meta.get("timeSig")
+    ts_num: Optional[int] = None
+    ts_den: Optional[int] = None
+    head, sep, tail = ts.partition("/") if isinstance(ts, str) else ("", "", "")
+    if sep:
+        try:
+            ts_num = _positive_int(head)
+            ts_den = _positive_int(tail)
+        except Exception:
+            ts_num = ts_den = None
+    return bpm, ts_num, ts_den
 
 
 def load_projects(projects_dir: Path) -> Dict[str, Dict[str, Any]]:
@@ -94,142 +221,184 @@ def load_projects(projects_dir: Path) -> Dict[str, Dict[str, Any]]:
     return projects
 
 
+def _json(obj: Any, status: int = 200) -> web.Response:
+    return web.Response(body=orjson.dumps(obj), status=status, content_type="application/json")
+
+
+async def _read_json(request: web.Request) -> Dict[str, Any]:
+    # orjson on the raw body; malformed or non-object bodies count as empty
+    try:
+        raw = await request.read()
+        payload = orjson.loads(raw) if raw else {}
+    except Exception:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
 async def http_health(_: web.Request) -> web.Response:
-    return web.json_response({"ok": True})
+    return web.Response(body=_HEALTH_BODY, content_type="application/json")
 
 
 async def http_projects(request: web.Request) -> web.Response:
     app_state: AppState = request.app["app_state"]
-    items = []
-    for pid, project in app_state.projects.items():
-        meta = project.get("meta") or {}
-        song = meta.get("song") or meta.get("name") or pid
-        artist = meta.get("artist") or ""
-        items.append({"id": pid, "song": song, "artist": artist})
-    return web.json_response(items)
+    return web.Response(body=app_state.projects_list_bytes, content_type="application/json")
 
 
 async def http_select(request: web.Request) -> web.Response:
     app_state: AppState = request.app["app_state"]
-    try:
-        payload = await request.json()
-    except Exception:
-        payload = {}
+    payload = await _read_json(request)
     pid = payload.get("projectId") or payload.get("id")
     if not pid or pid not in app_state.projects:
-        return web.json_response({"ok": False, "error": "project not found"}, status=404)
+        return _json({"ok": False, "error": "project not found"}, status=404)
 
     # update active project
-    app_state.active_project_id = pid
-
-    # reset state & update bpm/ts from project meta
-    project = app_state.projects[pid]
-    meta = project.get("meta") or {}
-    bpm = meta.get("bpm") or meta.get("tempo") or app_state.state.bpm
-    ts = meta.get("timeSig")
-    ts_num = app_state.state.ts_num
-    ts_den = app_state.state.ts_den
-    if isinstance(ts, str) and "/" in ts:
-        try:
-            ts_num = int(ts.split("/")[0])
-            ts_den = int(ts.split("/")[1])
-        except Exception:
-            pass
-
-    app_state.state.bar = 1
-    app_state.state.beat = 1
-    app_state.state.ppq = 0.0
-    app_state.state.bpm = float(bpm)
-    app_state.state.ts_num = ts_num
-    app_state.state.ts_den = ts_den
+    app_state.set_active_project(pid)
+
+    # reset state & update bpm/ts from project meta (keep current values if unset)
+    bpm, ts_num, ts_den = app_state.project_timing[pid]
+    s = app_state.state
+    s.bar = 1
+    s.beat = 1
+    s.ppq = 0.0
+    if bpm:
+        s.bpm = bpm
+    if ts_num and ts_den:
+        s.ts_num = ts_num
+        s.ts_den = ts_den
+    s.t_host = time.time()
 
     # broadcast new state to clients
-    msg = json.dumps(app_state.state_payload())
-    dead: Set[web.WebSocketResponse] = set()
-    for ws in app_state.ws_clients:
-        try:
-            await ws.send_str(msg)
-        except Exception:
-            dead.add(ws)
-    for ws in dead:
-        app_state.ws_clients.discard(ws)
+    app_state.broadcast(orjson.dumps(app_state.state_payload()))
 
-    return web.json_response({"ok": True, "projectId": pid})
+    return _json({"ok": True, "projectId": pid})
 
 
 async def http_project(request: web.Request) -> web.Response:
     app_state: AppState = request.app["app_state"]
-    return web.json_response(app_state.get_active_project())
+    # the active project changes on /api/select, so clients must revalidate;
+    # an unchanged project costs a 304 with no body
+    etag = app_state.project_etag
+    if any(e.value == etag or e.value == ETAG_ANY for e in request.if_none_match or ()):
+        resp = web.Response(status=304)
+    else:
+        resp = web.Response(body=app_state.project_bytes, content_type="application/json")
+    resp.etag = etag
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 
 async def http_get_state(request: web.Request) -> web.Response:
     app_state: AppState = request.app["app_state"]
-    return web.json_response(app_state.state_payload())
+    return _json(app_state.state_payload())
 
 
 async def http_set_state(request: web.Request) -> web.Response:
     app_state: AppState = request.app["app_state"]
-    try:
-        payload = await request.json()
-    except Exception:
-        payload = {}
+    payload = await _read_json(request)
 
-    for k in ("playing", "bar", "beat", "bpm", "ppq", "ts_num", "ts_den"):
-        if k in payload:
-            setattr(app_state.state, k, payload[k])
-
-    # broadcast new state
-    msg = json.dumps(app_state.state_payload())
-    dead: Set[web.WebSocketResponse] = set()
-    for ws in app_state.ws_clients:
-        try:
-            await ws.send_str(msg)
-        except Exception:
-            dead.add(ws)
-    for ws in dead:
-        app_state.ws_clients.discard(ws)
-
-    return web.json_response({"ok": True, "state": app_state.state_payload()})
+    # coerce and clamp every field first so a bad value leaves the state untouched
+    s = app_state.state
+    try:
+        playing = bool(payload["playing"]) if "playing" in payload else s.playing
+        bar = _positive_int(payload["bar"]) if "bar" in payload else s.bar
+        beat = _positive_int(payload["beat"]) if "beat" in payload else s.beat
+        bpm = float(payload["bpm"] or 120.0) if "bpm" in payload else s.bpm
+        ppq = float(payload["ppq"] or 0.0) if "ppq" in payload else s.ppq
+        ts_num = _positive_int(payload["ts_num"]) if "ts_num" in payload else s.ts_num
+        ts_den = _positive_int(payload["ts_den"]) if "ts_den" in payload else s.ts_den
+    except (TypeError, ValueError, OverflowError):
+        return _json({"ok": False, "error": "invalid state"}, status=400)
+
+    s.playing = playing
+    s.bar = bar
+    s.beat = beat
+    s.bpm = bpm
+    s.ppq = ppq
+    s.ts_num = ts_num
+    s.ts_den = ts_den
+    s.t_host = time.time()
+
+    # broadcast on the next coalescing tick; reply with the state as of this update
+    app_state.schedule_broadcast()
+
+    raw = orjson.dumps(app_state.state_payload())
+    body = b'{"ok":true,"state":' + raw + b"}"
+    return web.Response(body=body, content_type="application/json")
+
+
+def _enable_tcp_keepalive(request: web.Request) -> None:
+    # dead-peer detection by the kernel instead of a ping timer per connection
+    sock = request.transport.get_extra_info("socket") if request.transport else None
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # keepalive probes only run on an idle connection; TCP_USER_TIMEOUT (ms)
+        # bounds detection while broadcasts are in flight to a vanished peer
+        for name, value in (
+            ("TCP_KEEPIDLE", 20),
+            ("TCP_KEEPINTVL", 5),
+            ("TCP_KEEPCNT", 3),
+            ("TCP_USER_TIMEOUT", 35000),
+        ):
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+    except OSError:
+        pass
 
 
 async def ws_state(request: web.Request) -> web.StreamResponse:
     app_state: AppState = request.app["app_state"]
-    ws = web.WebSocketResponse(heartbeat=20)
+    heartbeat: Optional[float] = request.app["ws_heartbeat"]
+    ws = web.WebSocketResponse(heartbeat=heartbeat)
     await ws.prepare(request)
+    if heartbeat is None:
+        _enable_tcp_keepalive(request)
 
-    app_state.ws_clients.add(ws)
+    app_state.ws_clients.append(ws)
+    try:
+        # send initial state (queued like broadcasts so per-client order holds)
+        app_state.send_latest(ws, orjson.dumps(app_state.state_payload()))
+
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+            if msg.type == WSMsgType.TEXT:
+                # exact matches first; only short frames pay for strip/lower
+                d = msg.data
+                if d == "ping" or d == "PING" or (len(d) <= 8 and d.strip().lower() == "ping"):
+                    await ws.send_str("pong")
+    finally:
+        app_state.remove_client(ws)
+    return ws
 
-    # send initial state
-    await ws.send_str(json.dumps(app_state.state_payload()))
 
-    async for msg in ws:
-        if msg.type == WSMsgType.ERROR:
-            break
-        if msg.type == WSMsgType.TEXT and msg.data.strip().lower() == "ping":
-            await ws.send_str("pong")
+async def _on_shutdown(app: web.Application) -> None:
+    # don't leave a coalesced broadcast timer or send tasks behind at exit
+    await app["app_state"].cancel_broadcast()
 
-    app_state.ws_clients.discard(ws)
-    return ws
 
+def build_app(
+    projects: Dict[str, Dict[str, Any]],
+    active_project_id: str,
+    ws_heartbeat: Optional[float] = None,
+) -> web.Application:
+    app_state = AppState(
+        projects=projects, active_project_id=active_project_id, state=TransportState()
+    )
 
-def build_app(projects: Dict[str, Dict[str, Any]], active_project_id: str) -> web.Application:
     # derive BPM and timesig from active project
-    meta = projects[active_project_id].get("meta") or {}
-    bpm = float(meta.get("bpm") or meta.get("tempo") or 120.0)
-    ts = meta.get("timeSig")
-    ts_num, ts_den = 4, 4
-    if isinstance(ts, str) and "/" in ts:
-        try:
-            ts_num = int(ts.split("/")[0])
-            ts_den = int(ts.split("/")[1])
-        except Exception:
-            pass
-
-    state = TransportState(bpm=bpm, ts_num=ts_num, ts_den=ts_den)
-    app_state = AppState(projects=projects, active_project_id=active_project_id, state=state)
+    bpm, ts_num, ts_den = app_state.project_timing[active_project_id]
+    app_state.state.bpm = bpm or 120.0
+    app_state.state.ts_num = ts_num or 4
+    app_state.state.ts_den = ts_den or 4
+    app_state.state.t_host = time.time()
 
     app = web.Application()
     app["app_state"] = app_state
+    # 0 or negative means "off", same as not setting it
+    app["ws_heartbeat"] = ws_heartbeat if ws_heartbeat and ws_heartbeat > 0 else None
+    app.on_shutdown.append(_on_shutdown)
     app.add_routes(
         [
             web.get("/api/health", http_health),
@@ -266,6 +435,13 @@ def main() -> None:
         default=int(os.environ.get("DRUMHUD_PORT", "8765")),
         help="Bind port (default: 8765)",
     )
+    parser.add_argument(
+        "--ws-heartbeat",
+        type=float,
+        # an empty value (common in env files) counts as unset
+        default=os.environ.get("DRUMHUD_WS_HEARTBEAT") or None,
+        help="WebSocket ping interval in seconds; 0 or unset = off, TCP keepalive is used",
+    )
     args = parser.parse_args()
 
     projects: Dict[str, Dict[str, Any]] = {}
@@ -291,8 +467,18 @@ def main() -> None:
         projects = {pid: data}
         active_project_id = pid
 
-    app = build_app(projects, active_project_id)
-    web.run_app(app, host=args.host, port=args.port)
+    app = build_app(projects, active_project_id, ws_heartbeat=args.ws_heartbeat)
+
+    # uvloop is optional (not available on Windows); fall back to the default loop
+    loop = None
+    try:
+        import uvloop
+
+        loop = uvloop.new_event_loop()
+    except ImportError:
+        pass
+
+    web.run_app(app, host=args.host, port=args.port, loop=loop)
 
 
 if __name__ == "__main__":